@@ -2,7 +2,75 @@
 import os
 import argparse
 import shutil
+import socket
 import subprocess
+import time
+import Queue
+import atexit
+import fcntl
+from contextlib import contextmanager
+
+P4D_BIN = "/usr/local/bin/p4d"
+P4_BIN = "/usr/local/bin/p4"
+
+# Files and directories (e.g. server.locks) at the top of a server root that
+# p4d writes to in place. These must be real copies in a clone; everything
+# else (the versioned depot archives) is replaced rather than modified, so it
+# can be hard linked.
+PRIVATE_FILE_PREFIXES = ("db.", "journal", "log", "state", "server.", "license")
+
+# Marker written into a snapshot once the restore has completed.
+SNAPSHOT_READY = ".snapshot_ready"
+
+# How many times the pool tries to start a server, each time on a new port,
+# since another process can grab a port between free_port() and p4d binding it.
+SPAWN_ATTEMPTS = 3
+
+
+def free_port():
+    """Return a TCP port on localhost that is currently unused."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def clone_tree(src, dest):
+    """
+    Clone the server root src into dest.
+
+    Depot archive files are hard linked, which makes the clone cheap no matter
+    how large the depot is. Database, journal, log and lock files are copied
+    since p4d writes to them in place. If hard links aren't possible (e.g. src
+    and dest are on different file systems) we fall back to copying.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        relative_dir = os.path.relpath(dirpath, src)
+        target_dir = os.path.join(dest, relative_dir)
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for name in filenames:
+            if relative_dir == os.curdir and name == SNAPSHOT_READY:
+                continue
+            src_file = os.path.join(dirpath, name)
+            dest_file = os.path.join(target_dir, name)
+
+            # Whether a file is private to a server depends on the first
+            # component of its path, so everything under server.locks is copied.
+            if relative_dir == os.curdir:
+                top = name
+            else:
+                top = relative_dir.split(os.sep)[0]
+            if top.startswith(PRIVATE_FILE_PREFIXES):
+                shutil.copy2(src_file, dest_file)
+                continue
+            try:
+                os.link(src_file, dest_file)
+            except OSError:
+                shutil.copy2(src_file, dest_file)
+
 
 class SampleDepot:
 
@@ -11,10 +79,11 @@ class SampleDepot:
         self.p4root = os.path.join(self.parent_dir, "PerforceSample")
         self.p4port = p4port
         self.tarball = tarball
-        self.p4d = "/usr/local/bin/p4d -r %s" % self.p4root
-        self.p4  = "/usr/local/bin/p4 -p %d" % self.p4port
+        self.p4d = "%s -r %s" % (P4D_BIN, self.p4root)
+        self.p4  = "%s -p %d" % (P4_BIN, self.p4port)
         self.start_cmd = "%s -p %d -d" % (self.p4d, self.p4port)
         self.stop_cmd = "%s admin stop" % self.p4
+        self.process = None
 
 
     def server_start(self):
@@ -22,15 +91,56 @@ class SampleDepot:
         print "Server started on port: %d" % self.p4port
 
 
-    def server_stop(self):
+    def server_spawn(self, timeout=30):
+        """
+        Start p4d as a child process and wait until it answers.
+
+        Unlike server_start, the server is not daemonized, so we keep a handle
+        on it and server_stop can kill it if 'p4 admin stop' doesn't work.
+        """
+        devnull = open(os.devnull, "w")
+        try:
+            self.process = subprocess.Popen([P4D_BIN, "-r", self.p4root, "-p", str(self.p4port)],
+                                            stdout=devnull, stderr=subprocess.STDOUT)
+        finally:
+            devnull.close()
+        self.wait_until_ready(timeout)
+
+
+    def wait_until_ready(self, timeout=30):
+        """Poll the server until it answers 'p4 info' or raise after timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.info()
+                return
+            except (subprocess.CalledProcessError, OSError):
+                if self.process is not None and self.process.poll() is not None:
+                    raise RuntimeError("p4d on port %d exited with code %d" % (self.p4port, self.process.returncode))
+                if time.time() > deadline:
+                    raise RuntimeError("p4d on port %d did not start within %d seconds" % (self.p4port, timeout))
+                time.sleep(0.1)
+
+
+    def server_stop(self, timeout=10):
         try:
             self.info()
-            subprocess.call(["/usr/local/bin/p4", "-p", "1492", "admin", "stop"])
+            subprocess.call([P4_BIN, "-p", str(self.p4port), "admin", "stop"])
             # TODO: should probably check error code here
             print "Server stopped on port: %s " % self.p4port
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, OSError):
             print "Already stopped?"
 
+        # If we started the server ourselves, make sure it's really gone.
+        if self.process is not None:
+            deadline = time.time() + timeout
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
     def server_delete(self):
         p4root = self.p4root
         if os.path.exists(p4root):
@@ -53,17 +163,180 @@ class SampleDepot:
         else:
             os.makedirs(self.parent_dir)
 
-        # Move to destination dir and unpack tarball
-        os.chdir(self.parent_dir)
-        os.system("tar xzf %s" % self.tarball)
+        # Unpack tarball in the destination dir
+        subprocess.check_call(["tar", "xzf", self.tarball, "-C", self.parent_dir])
 
         # Restore checkpoint and upgrade db files to our server
-        os.system("%s -jr %s" % (self.p4d, os.path.join(self.p4root, "checkpoint")))
-        os.system("%s -xu" % self.p4d)
+        subprocess.check_call([P4D_BIN, "-r", self.p4root, "-jr", os.path.join(self.p4root, "checkpoint")])
+        subprocess.check_call([P4D_BIN, "-r", self.p4root, "-xu"])
+
+
+    def server_clone(self, snapshot):
+        """Install the server root as a clone of a prepared SnapshotCache."""
+        if os.path.isdir(self.parent_dir):
+            self.server_delete()
+        else:
+            os.makedirs(self.parent_dir)
+        clone_tree(snapshot.prepare(), self.p4root)
 
 
     def info(self):
-        subprocess.check_output(["/usr/local/bin/p4", "-p", "1492", "info"])
+        subprocess.check_output([P4_BIN, "-p", str(self.p4port), "info"])
+
+
+class SnapshotCache:
+    """
+    A restored sample depot server root that is built once and then cloned.
+
+    Untarring the sample depot and replaying the checkpoint is slow, so we do
+    it a single time in cache_dir and hand out clones of the result.
+    """
+
+    def __init__(self, tarball, cache_dir):
+        # No server ever runs on the snapshot, so don't tie it to a real port.
+        self.depot = SampleDepot(tarball, cache_dir, free_port())
+        self.p4root = self.depot.p4root
+
+    def is_ready(self):
+        return os.path.isfile(os.path.join(self.p4root, SNAPSHOT_READY))
+
+    def prepare(self):
+        """
+        Build the snapshot if it doesn't exist yet and return its server root.
+
+        Test processes may share a cache dir, so the build is done under a lock.
+        """
+        if not os.path.isdir(self.depot.parent_dir):
+            os.makedirs(self.depot.parent_dir)
+        lock_file = open(os.path.join(self.depot.parent_dir, ".snapshot.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not self.is_ready():
+                # Throw away anything a failed build left behind. Doing it here
+                # keeps server_install from trying to stop a server first.
+                if os.path.isdir(self.p4root):
+                    shutil.rmtree(self.p4root)
+                self.depot.server_install()
+                open(os.path.join(self.p4root, SNAPSHOT_READY), "w").close()
+        finally:
+            lock_file.close()
+        return self.p4root
+
+    def clone(self, parent_dir, p4port=None):
+        """Return a SampleDepot in parent_dir cloned from the snapshot."""
+        if p4port is None:
+            p4port = free_port()
+        depot = SampleDepot(self.depot.tarball, parent_dir, p4port)
+        depot.server_clone(self)
+        return depot
+
+    def delete(self):
+        if os.path.isdir(self.p4root):
+            shutil.rmtree(self.p4root)
+
+
+class ServerPool:
+    """
+    Run a number of sample depot servers on free ports for parallel tests.
+
+    Each server gets its own clone of the snapshot. Workers borrow a server
+    with acquire() (or the server() context manager) and give it back with
+    release(). Pass reset=True to release() to throw away whatever the test
+    did and give the next worker a fresh clone. If the fresh server won't
+    start, the pool gets smaller.
+    """
+
+    def __init__(self, snapshot, work_dir, size):
+        self.snapshot = snapshot
+        self.work_dir = os.path.abspath(work_dir)
+        self.size = size
+        self.servers = []
+        self.available = Queue.Queue()
+        atexit.register(self.shutdown)
+
+    def start(self):
+        self.snapshot.prepare()
+        try:
+            for i in range(self.size):
+                depot = self._new_server(i)
+                self.servers.append(depot)
+                self.available.put(depot)
+        except:
+            self.shutdown()
+            raise
+        return self
+
+    def _new_server(self, index):
+        for attempt in range(SPAWN_ATTEMPTS):
+            # Each clone gets a new free port.
+            depot = self.snapshot.clone(os.path.join(self.work_dir, "server-%d" % index))
+            depot.pool_index = index
+            try:
+                depot.server_spawn()
+                return depot
+            except:
+                # It isn't in self.servers yet, so shutdown wouldn't find it.
+                self._discard(depot)
+                if attempt == SPAWN_ATTEMPTS - 1:
+                    raise
+
+    def acquire(self, timeout=None):
+        try:
+            depot = self.available.get(timeout=timeout)
+        except Queue.Empty:
+            raise RuntimeError("No sample depot server became available within %s seconds" % timeout)
+        if depot is None:
+            # The pool has no servers left. Pass the news on to the next waiter.
+            self.available.put(None)
+            raise RuntimeError("The sample depot server pool has no servers left")
+        return depot
+
+    def release(self, depot, reset=False):
+        if reset:
+            index = depot.pool_index
+            self._discard(depot)
+            try:
+                depot = self._new_server(index)
+            except:
+                # Drop the slot, so nobody waits forever for a server that isn't coming back.
+                self.servers[index] = None
+                self.size -= 1
+                if self.size == 0:
+                    self.available.put(None)
+                raise
+            self.servers[index] = depot
+        self.available.put(depot)
+
+    @contextmanager
+    def server(self, timeout=None, reset=False):
+        depot = self.acquire(timeout)
+        try:
+            yield depot
+        finally:
+            self.release(depot, reset)
+
+    def _discard(self, depot):
+        try:
+            depot.server_stop()
+        finally:
+            if os.path.isdir(depot.parent_dir):
+                shutil.rmtree(depot.parent_dir, ignore_errors=True)
+
+    def shutdown(self):
+        """Stop every server and delete its clone. Safe to call more than once."""
+        servers, self.servers = [d for d in self.servers if d is not None], []
+        for depot in servers:
+            try:
+                self._discard(depot)
+            except Exception, e:
+                print "Failed to tear down server on port %d: %s" % (depot.p4port, e)
+        self.available = Queue.Queue()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, etype, value, traceback):
+        self.shutdown()
 
 
 def parse_options():
@@ -71,6 +344,9 @@ def parse_options():
     parser.add_argument("dir", help="Directory to install depot - will overwrite all contents.")
     parser.add_argument("tarfile", help="Gzipped tar file containing contents of sample depot.")
     parser.add_argument("-p", "--prompt", action="store_true", help="Prompt if destination directory exists.")
+    parser.add_argument("--port", type=int, default=1492, help="Port for the server. Default is 1492.")
+    parser.add_argument("--snapshot", metavar="DIR",
+                        help="Clone from a restored snapshot kept in DIR, creating it if needed.")
     return parser.parse_args()
 
 
@@ -80,11 +356,14 @@ def main():
     destination = os.path.abspath(args.dir)
     tarfile = os.path.abspath(args.tarfile)
 
-    p4 = SampleDepot(tarfile, destination)
-    p4.server_install()
+    p4 = SampleDepot(tarfile, destination, args.port)
+    if args.snapshot:
+        p4.server_clone(SnapshotCache(tarfile, args.snapshot))
+    else:
+        p4.server_install()
     p4.server_start()
     p4.info()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
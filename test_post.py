@@ -0,0 +1,660 @@
+from unittest import TestCase
+from StringIO import StringIO
+import gzip
+import imp
+import marshal
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+import urllib2
+
+# post is a script that needs rbtools, so load it with the stub rbtools in test_stubs.
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "test_stubs"))
+saved_dont_write_bytecode = sys.dont_write_bytecode
+sys.dont_write_bytecode = True
+try:
+    post = imp.load_source("post", os.path.join(HERE, "post"))
+finally:
+    sys.dont_write_bytecode = saved_dont_write_bytecode
+
+
+def parse_options(args):
+    """Return post's options for the command line args."""
+    saved_argv = sys.argv
+    sys.argv = ["post"] + args
+    try:
+        options, args, action = post.parse_options(post.get_option_parser())
+    finally:
+        sys.argv = saved_argv
+    return options
+
+
+class Struct:
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeReviewRequest:
+    """Review request resource whose diff count goes through counts, one value per call."""
+
+    def __init__(self, counts):
+        self.counts = list(counts)
+        self.links = Struct(diffs=Struct(href="http://rb.example.com/api/review-requests/42/diffs/"))
+
+
+    def get_diffs(self, counts_only=False):
+        return Struct(count=self.counts.pop(0))
+
+
+def http_error(code):
+    return urllib2.HTTPError("http://rb.example.com/", code, "error", {}, StringIO("error body"))
+
+
+class TestDiffUploaderBody(TestCase):
+
+    def setUp(self):
+        post.options = parse_options(["edit", "1234"])
+        self.uploader = post.DiffUploader("http://rb.example.com")
+        self.uploader.spool("path", "diff", "--- a\n+++ b\n")
+        self.uploader.spool("parent_diff_path", "parent_diff", "--- c\n+++ d\n")
+
+
+    def tearDown(self):
+        self.uploader.cleanup()
+
+
+    def read_body(self, compress):
+        content_type, body_file = self.uploader.get_body({"basedir": "/"}, compress)
+        f = open(body_file, "rb")
+        try:
+            body = f.read()
+        finally:
+            f.close()
+        if compress:
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        return content_type, body
+
+
+    def test_body(self):
+        content_type, body = self.read_body(False)
+        boundary = content_type.split("boundary=")[1]
+        self.assertTrue(content_type.startswith("multipart/form-data; "))
+        self.assertEqual("--%s\r\n"
+                         "Content-Disposition: form-data; name=\"basedir\"\r\n\r\n/\r\n"
+                         "--%s\r\n"
+                         "Content-Disposition: form-data; name=\"path\"; filename=\"diff\"\r\n\r\n"
+                         "--- a\n+++ b\n\r\n"
+                         "--%s\r\n"
+                         "Content-Disposition: form-data; name=\"parent_diff_path\"; filename=\"parent_diff\"\r\n\r\n"
+                         "--- c\n+++ d\n\r\n"
+                         "--%s--\r\n\r\n" % ((boundary,) * 4), body)
+
+
+    def test_compressed_body(self):
+        plain_type, plain = self.read_body(False)
+        gzip_type, unzipped = self.read_body(True)
+        self.assertEqual(plain.replace(plain_type.split("boundary=")[1], "BOUNDARY"),
+                         unzipped.replace(gzip_type.split("boundary=")[1], "BOUNDARY"))
+
+
+    def test_body_reused(self):
+        first = self.uploader.get_body({}, False)
+        self.assertEqual(first, self.uploader.get_body({}, False))
+        self.assertNotEqual(first, self.uploader.get_body({}, True))
+
+
+    def test_cleanup(self):
+        content_type, body_file = self.uploader.get_body({}, False)
+        temp_files = [f for field, filename, f in self.uploader.files] + [body_file]
+        self.uploader.cleanup()
+        for file_name in temp_files:
+            self.assertFalse(os.path.exists(file_name))
+
+
+class TestDiffUploader(TestCase):
+
+    def setUp(self):
+        post.options = parse_options(["edit", "1234"])
+        post.gzip_servers.clear()
+        self.sleeps = []
+        self.saved_sleep = time.sleep
+        time.sleep = self.sleeps.append
+        self.saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+
+        self.uploader = post.DiffUploader("http://rb.example.com")
+        self.uploader.spool("path", "diff", "x" * 100)
+        self.uploader.upload_size = lambda: post.UPLOAD_COMPRESS_MIN_SIZE
+        self.uploader.gzip_supported = lambda: True
+
+        # Answer each POST with the next result: a response body or an exception.
+        self.results = []
+        self.posts = []
+        self.uploader.post = self.fake_post
+
+
+    def tearDown(self):
+        time.sleep = self.saved_sleep
+        sys.stdout = self.saved_stdout
+        self.uploader.cleanup()
+        post.gzip_servers.clear()
+
+
+    def fake_post(self, url, fields, compress):
+        self.posts.append(compress)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    def test_upload(self):
+        self.results = ['{"stat": "ok"}']
+        self.assertEqual('{"stat": "ok"}', self.uploader.upload_diff(FakeReviewRequest([0])))
+        self.assertEqual([True], self.posts)
+
+
+    def test_small_upload_not_compressed(self):
+        self.uploader.upload_size = lambda: post.UPLOAD_COMPRESS_MIN_SIZE - 1
+        self.results = ['{"stat": "ok"}']
+        self.uploader.upload_diff(FakeReviewRequest([0]))
+        self.assertEqual([False], self.posts)
+
+
+    def test_no_compress_option(self):
+        self.uploader.compress = False
+        self.results = ['{"stat": "ok"}']
+        self.uploader.upload_diff(FakeReviewRequest([0]))
+        self.assertEqual([False], self.posts)
+
+
+    def test_gzip_rejected(self):
+        self.results = [http_error(415), '{"stat": "ok"}']
+        self.assertEqual('{"stat": "ok"}', self.uploader.upload_diff(FakeReviewRequest([0])))
+        self.assertEqual([True, False], self.posts)
+        self.assertEqual([], self.sleeps)
+        self.assertEqual(False, post.gzip_servers["http://rb.example.com/"])
+
+
+    def test_415_uncompressed_not_retried(self):
+        self.uploader.compress = False
+        self.results = [http_error(415)]
+        self.assertRaises(post.RBError, self.uploader.upload_diff, FakeReviewRequest([0]))
+        self.assertEqual([False], self.posts)
+
+
+    def test_transient_error_retried(self):
+        self.results = [http_error(503), urllib2.URLError("connection refused"), '{"stat": "ok"}']
+        self.assertEqual('{"stat": "ok"}', self.uploader.upload_diff(FakeReviewRequest([0, 0, 0])))
+        self.assertEqual(3, len(self.posts))
+        self.assertEqual(2, len(self.sleeps))
+        self.assertTrue(self.sleeps[1] > self.sleeps[0])
+
+
+    def test_upload_that_made_it_not_resent(self):
+        # The server stored the diff, but a proxy answered 502.
+        self.results = [http_error(502)]
+        self.assertEqual(None, self.uploader.upload_diff(FakeReviewRequest([3, 4])))
+        self.assertEqual(1, len(self.posts))
+        self.assertTrue("went through after all" in sys.stdout.getvalue())
+
+
+    def test_count_check_failure_not_resent(self):
+        review_request = FakeReviewRequest([0])
+        def get_diffs(counts_only=False):
+            if review_request.counts:
+                return Struct(count=review_request.counts.pop(0))
+            raise urllib2.URLError("connection refused")
+        review_request.get_diffs = get_diffs
+        self.results = [http_error(504)]
+        self.assertRaises(post.RBError, self.uploader.upload_diff, review_request)
+        self.assertEqual(1, len(self.posts))
+
+
+    def test_permanent_error_not_retried(self):
+        self.results = [http_error(400)]
+        self.assertRaises(post.RBError, self.uploader.upload_diff, FakeReviewRequest([0]))
+        self.assertEqual(1, len(self.posts))
+        self.assertEqual([], self.sleeps)
+
+
+    def test_retries_give_up(self):
+        self.results = [http_error(503)] * post.UPLOAD_RETRIES
+        self.assertRaises(post.RBError, self.uploader.upload_diff, FakeReviewRequest([0] * post.UPLOAD_RETRIES))
+        self.assertEqual(post.UPLOAD_RETRIES, len(self.posts))
+
+
+class TestGzipSupported(TestCase):
+
+    def setUp(self):
+        post.options = parse_options(["edit", "1234"])
+        post.gzip_servers.clear()
+        self.requests = []
+        self.accept_encoding = None
+        self.saved_urlopen = urllib2.urlopen
+        urllib2.urlopen = self.fake_urlopen
+
+
+    def tearDown(self):
+        urllib2.urlopen = self.saved_urlopen
+        post.gzip_servers.clear()
+
+
+    def fake_urlopen(self, request, timeout=None):
+        self.requests.append((request.get_method(), request.get_full_url()))
+        headers = {}
+        if self.accept_encoding:
+            headers['Accept-Encoding'] = self.accept_encoding
+        return Struct(info=lambda: Struct(getheader=headers.get))
+
+
+    def test_accepts_gzip(self):
+        self.accept_encoding = "gzip, deflate"
+        self.assertTrue(post.DiffUploader("http://rb.example.com/reviews").gzip_supported())
+        self.assertEqual([("HEAD", "http://rb.example.com/reviews/api/")], self.requests)
+
+
+    def test_no_accept_encoding(self):
+        self.assertFalse(post.DiffUploader("http://rb.example.com/").gzip_supported())
+
+
+    def test_answer_remembered(self):
+        self.accept_encoding = "gzip"
+        post.DiffUploader("http://rb.example.com/").gzip_supported()
+        self.assertTrue(post.DiffUploader("http://rb.example.com/").gzip_supported())
+        self.assertEqual(1, len(self.requests))
+
+
+class FakeP4:
+    user = "me"
+
+
+class TestReviewWatcher(TestCase):
+
+    def setUp(self):
+        post.options = parse_options(["watch"])
+        self.now = 1000.0
+        self.saved_time = time.time
+        time.time = lambda: self.now
+        self.saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+
+        self.watcher = post.ReviewWatcher(None, "http://rb.example.com/", FakeP4(), 30)
+        self.state = {"1234": {"//depot/a.c": ("edit", "3", "text", 1.0, 100)}}
+        self.watcher.opened_state = lambda: self.state
+        self.watcher.get_review_id = lambda change, now: int(change)
+
+        # Uploads append (review id, diff) to self.uploads.
+        self.diffs = {"1234": "diff 1"}
+        self.uploads = []
+        self.watcher.diff = lambda change, files: self.diffs[change]
+        self.watcher.api_root = Struct(get_review_request=lambda review_request_id: Struct(id=review_request_id))
+        self.saved_upload_diff = post.DiffUploader.upload_diff
+        def upload_diff(uploader, review_request):
+            f = open(uploader.files[0][2])
+            try:
+                self.uploads.append((review_request.id, f.read()))
+            finally:
+                f.close()
+        post.DiffUploader.upload_diff = upload_diff
+
+
+    def tearDown(self):
+        time.time = self.saved_time
+        sys.stdout = self.saved_stdout
+        post.DiffUploader.upload_diff = self.saved_upload_diff
+
+
+    def edit(self, change, depot_file, mtime):
+        action, rev, file_type, old_mtime, size = self.state[change][depot_file]
+        self.state[change][depot_file] = (action, rev, file_type, mtime, size)
+
+
+    def poll(self, seconds_later=30):
+        self.now += seconds_later
+        self.watcher.poll()
+
+
+    def test_debounce(self):
+        self.poll()
+        self.assertEqual([], self.uploads)
+        self.poll()
+        self.assertEqual([(1234, "diff 1")], self.uploads)
+        self.poll()
+        self.assertEqual(1, len(self.uploads))
+
+
+    def test_no_upload_while_files_change(self):
+        for mtime in range(2, 6):
+            self.edit("1234", "//depot/a.c", mtime)
+            self.poll()
+        self.assertEqual([], self.uploads)
+
+
+    def test_rate_limit(self):
+        self.poll()
+        self.poll()
+        self.edit("1234", "//depot/a.c", 2.0)
+        self.diffs["1234"] = "diff 2"
+        self.poll()
+        self.poll()
+        self.assertEqual(1, len(self.uploads))
+
+        # Once WATCH_MIN_UPLOAD_INTERVAL has passed, the change goes up.
+        self.poll(post.WATCH_MIN_UPLOAD_INTERVAL)
+        self.assertEqual((1234, "diff 2"), self.uploads[-1])
+
+
+    def test_unchanged_diff_not_uploaded(self):
+        self.poll()
+        self.poll()
+        self.edit("1234", "//depot/a.c", 2.0)
+        self.poll(post.WATCH_MIN_UPLOAD_INTERVAL)
+        self.poll()
+        self.assertEqual(1, len(self.uploads))
+
+        # The touched files aren't diffed again, and the rate limit wasn't charged.
+        self.watcher.diff = None
+        self.poll()
+        self.assertEqual(self.watcher.signature(self.state["1234"]), self.watcher.uploaded["1234"][0])
+        self.assertEqual(1060.0, self.watcher.uploaded["1234"][1])
+
+
+    def test_no_review(self):
+        self.watcher.get_review_id = lambda change, now: None
+        self.poll()
+        self.poll()
+        self.assertEqual([], self.uploads)
+
+
+    def test_failure_does_not_hold_up_other_changes(self):
+        self.state["999"] = {"//depot/b.c": ("edit", "1", "text", 1.0, 10)}
+        self.diffs["999"] = "diff 999"
+        def diff(change, files):
+            if change == "1234":
+                raise post.RBError("review 42 is broken")
+            return self.diffs[change]
+        self.watcher.diff = diff
+        self.poll()
+        self.poll()
+        self.assertEqual([(999, "diff 999")], self.uploads)
+
+        # The broken change waits out its own backoff before it's tried again.
+        self.watcher.diff = lambda change, files: self.diffs[change]
+        self.poll()
+        self.assertEqual(1, len(self.uploads))
+        self.poll(2 * 30)
+        self.assertEqual((1234, "diff 1"), self.uploads[-1])
+        self.assertEqual({}, self.watcher.failures)
+
+
+    def test_gone_changes_forgotten(self):
+        self.poll()
+        self.poll()
+        self.state.clear()
+        self.poll()
+        for cache in (self.watcher.pending, self.watcher.uploaded, self.watcher.diff_hashes):
+            self.assertEqual({}, cache)
+
+
+class TestFrames(TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.f = self.theirs.makefile("rb")
+
+
+    def tearDown(self):
+        self.f.close()
+        self.ours.close()
+        self.theirs.close()
+
+
+    def test_round_trip(self):
+        post.send_frame(self.ours, 'o', "two\nlines\n")
+        post.send_frame(self.ours, 'x', "0")
+        post.send_frame(self.ours, 'g', "")
+        self.assertEqual(('o', "two\nlines\n"), post.read_frame(self.f))
+        self.assertEqual(('x', "0"), post.read_frame(self.f))
+        self.assertEqual(('g', ""), post.read_frame(self.f))
+
+
+    def test_closed(self):
+        self.ours.close()
+        self.assertRaises(EOFError, post.read_frame, self.f)
+
+
+    def test_truncated(self):
+        self.ours.sendall("o 10\nshort")
+        self.ours.close()
+        self.assertRaises(EOFError, post.read_frame, self.f)
+
+
+    def test_garbage(self):
+        self.ours.sendall("nonsense\n")
+        self.assertRaises(ValueError, post.read_frame, self.f)
+
+
+def fake_run_post():
+    """What the helper runs in TestHelper instead of a real post command."""
+    f = open(os.path.join(os.environ['TEST_HELPER_DIR'], "ran"), "a")
+    f.write("ran\n")
+    f.close()
+    print "hello"
+    sys.stderr.write("warning\n")
+    os.system("echo child-out; echo child-err >&2")
+    raise SystemExit(3)
+
+
+class TestHelper(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp, "helper", "socket")
+        self.saved = (post.helper_socket_path, post.start_helper, post.HELPER_ACK_TIMEOUT, sys.stdout, sys.stderr,
+                      sys.argv, os.environ.get('TEST_HELPER_DIR'))
+        post.helper_socket_path = lambda: self.socket_path
+        # The helper and its clients are versioned by the script in argv[0].
+        sys.argv = [post.__file__, "edit", "1234"]
+        post.start_helper = lambda: None
+        os.environ['TEST_HELPER_DIR'] = self.tmp
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                post.helper_can_run = lambda args: not os.path.exists(os.path.join(self.tmp, "in-process"))
+                post.run_post = fake_run_post
+                post.PostHelper(self.socket_path).serve()
+            except:
+                traceback.print_exc()
+            os._exit(0)
+
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+        sys.stdout = StringIO()
+        sys.stderr = StringIO()
+
+
+    def tearDown(self):
+        (post.helper_socket_path, post.start_helper, post.HELPER_ACK_TIMEOUT, sys.stdout, sys.stderr,
+         sys.argv, helper_dir) = self.saved
+        if helper_dir is None:
+            del os.environ['TEST_HELPER_DIR']
+        else:
+            os.environ['TEST_HELPER_DIR'] = helper_dir
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        shutil.rmtree(self.tmp)
+
+
+    def runs(self):
+        try:
+            return len(open(os.path.join(self.tmp, "ran")).readlines())
+        except IOError:
+            return 0
+
+
+    def connect(self, version=None):
+        """Send a request like run_in_helper does and return the socket and a file to read frames from."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        request = {
+            'argv': sys.argv,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+            'version': version or post.helper_version(),
+        }
+        post.send_frame(sock, 'r', marshal.dumps(request))
+        return sock, sock.makefile("rb")
+
+
+    def test_run(self):
+        self.assertEqual(3, post.run_in_helper())
+        self.assertEqual(1, self.runs())
+        self.assertEqual("hello\nchild-out\n", sys.stdout.getvalue())
+        self.assertEqual("warning\nchild-err\n", sys.stderr.getvalue())
+
+
+    def test_helper_stays_up(self):
+        self.assertEqual(3, post.run_in_helper())
+        self.assertEqual(3, post.run_in_helper())
+        self.assertEqual(2, self.runs())
+
+
+    def test_fallback(self):
+        open(os.path.join(self.tmp, "in-process"), "w").close()
+        self.assertEqual(None, post.run_in_helper())
+        self.assertEqual(0, self.runs())
+
+
+    def test_no_go_no_run(self):
+        sock, f = self.connect()
+        self.assertEqual(('a', ''), post.read_frame(f))
+        f.close()
+        sock.close()
+
+        # Requests are handled in order, so the first one is done with by the
+        # time this returns. Only this one ran.
+        self.assertEqual(3, post.run_in_helper())
+        self.assertEqual(1, self.runs())
+
+
+    def test_old_helper_declines(self):
+        sock, f = self.connect(version=("/somewhere/else/post", 0))
+        try:
+            self.assertEqual(('f', ''), post.read_frame(f))
+        finally:
+            f.close()
+            sock.close()
+
+        # It also shuts down, so the next run starts a new one.
+        os.waitpid(self.pid, 0)
+        self.pid = None
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertEqual(0, self.runs())
+
+
+class TestBusyHelper(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp, "socket")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(1)
+        self.saved = (post.helper_socket_path, post.HELPER_ACK_TIMEOUT, sys.argv)
+        post.helper_socket_path = lambda: self.socket_path
+        sys.argv = [post.__file__, "edit", "1234"]
+        post.HELPER_ACK_TIMEOUT = 0.1
+
+
+    def tearDown(self):
+        post.helper_socket_path, post.HELPER_ACK_TIMEOUT, sys.argv = self.saved
+        self.listener.close()
+        shutil.rmtree(self.tmp)
+
+
+    def test_no_ack(self):
+        # The connection is accepted, but nobody answers it.
+        self.assertEqual(None, post.run_in_helper())
+
+
+    def test_not_private(self):
+        os.chmod(self.tmp, 0755)
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertEqual(None, post.run_in_helper())
+        finally:
+            sys.stderr = saved_stderr
+
+
+class TestHelperCanRun(TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.saved_home = os.environ['HOME']
+        os.environ['HOME'] = self.home
+
+
+    def tearDown(self):
+        os.environ['HOME'] = self.saved_home
+        shutil.rmtree(self.home)
+
+
+    def write_cookie(self, name, expires, file_name=".rbtools-cookies"):
+        f = open(os.path.join(self.home, file_name), "w")
+        try:
+            f.write("# Netscape HTTP Cookie File\n")
+            f.write("rb.example.com\tFALSE\t/\tFALSE\t%d\t%s\tabc\n" % (expires, name))
+        finally:
+            f.close()
+
+
+    def test_session(self):
+        self.write_cookie("rbsessionid", time.time() + 3600)
+        self.assertTrue(post.has_rb_session(self.home))
+        self.assertTrue(post.helper_can_run(["edit", "1234"]))
+
+
+    def test_expired_session(self):
+        self.write_cookie("rbsessionid", time.time() - 3600)
+        self.assertFalse(post.has_rb_session(self.home))
+        self.assertFalse(post.helper_can_run(["edit", "1234"]))
+
+
+    def test_no_cookies(self):
+        self.assertFalse(post.has_rb_session(self.home))
+        self.write_cookie("csrftoken", time.time() + 3600)
+        self.assertFalse(post.has_rb_session(self.home))
+
+
+    def test_post_review_cookies(self):
+        self.write_cookie("rbsessionid", time.time() + 3600, ".post-review-cookies.txt")
+        self.assertTrue(post.has_rb_session(self.home))
+
+
+    def test_diff_needs_no_session(self):
+        self.assertTrue(post.helper_can_run(["diff", "1234"]))
+
+
+    def test_terminal_commands(self):
+        self.write_cookie("rbsessionid", time.time() + 3600)
+        self.assertFalse(post.helper_can_run(["watch"]))
+        self.assertFalse(post.helper_can_run(["create"]))
+        self.assertFalse(post.helper_can_run(["-e", "submit", "1234"]))
+
+
+    def test_stdin(self):
+        stdin = post.HelperStdin()
+        self.assertRaises(post.RBError, stdin.readline)
+        self.assertRaises(post.RBError, stdin.read)
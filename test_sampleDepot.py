@@ -1,6 +1,11 @@
 from unittest import TestCase
-from p4_sample_depot import SampleDepot
+from p4_sample_depot import SampleDepot, SnapshotCache, ServerPool, SNAPSHOT_READY, SPAWN_ATTEMPTS, P4_BIN, clone_tree, free_port
+import p4_sample_depot
 import os
+import shutil
+import socket
+import subprocess
+import tempfile
 
 class TestSampleDepot(TestCase):
 
@@ -27,3 +32,295 @@ class TestSampleDepot(TestCase):
 
     def test_stop_command(self):
         self.assertEqual("/usr/local/bin/p4 -p 1492 admin stop", self.sd.stop_cmd)
+
+
+    def test_stop_command_custom_port(self):
+        sd = SampleDepot("sample.tar.gz", "foobar", 2001)
+        self.assertEqual("/usr/local/bin/p4 -p 2001 admin stop", sd.stop_cmd)
+
+
+class TestServerCommands(TestCase):
+
+    def setUp(self):
+        self.commands = []
+        self.saved = (subprocess.call, subprocess.check_output)
+        subprocess.call = self.commands.append
+        subprocess.check_output = self.commands.append
+        self.sd = SampleDepot("sample.tar.gz", "foobar", 2001)
+
+
+    def tearDown(self):
+        subprocess.call, subprocess.check_output = self.saved
+
+
+    def test_info_uses_port(self):
+        self.sd.info()
+        self.assertEqual([[P4_BIN, "-p", "2001", "info"]], self.commands)
+
+
+    def test_server_stop_uses_port(self):
+        self.sd.server_stop()
+        self.assertEqual([[P4_BIN, "-p", "2001", "info"], [P4_BIN, "-p", "2001", "admin", "stop"]], self.commands)
+
+
+def failing_spawn(depot, timeout=30):
+    raise RuntimeError("p4d did not start")
+
+
+class TestServerPool(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.snapshot = SnapshotCache("sample.tar.gz", os.path.join(self.tmp, "cache"))
+        os.makedirs(self.snapshot.p4root)
+        for name in ["db.have", SNAPSHOT_READY]:
+            open(os.path.join(self.snapshot.p4root, name), "w").close()
+
+        # Pretend to run servers.
+        self.spawned = []
+        self.stopped = []
+        self.saved = (SampleDepot.server_spawn, SampleDepot.server_stop)
+        SampleDepot.server_spawn = lambda depot, timeout=30: self.spawned.append(depot)
+        SampleDepot.server_stop = lambda depot, timeout=10: self.stopped.append(depot)
+        self.pool = ServerPool(self.snapshot, os.path.join(self.tmp, "work"), 2)
+
+
+    def tearDown(self):
+        self.pool.shutdown()
+        SampleDepot.server_spawn, SampleDepot.server_stop = self.saved
+        shutil.rmtree(self.tmp)
+
+
+    def test_start(self):
+        self.pool.start()
+        self.assertEqual(2, len(self.spawned))
+        self.assertNotEqual(self.spawned[0].p4port, self.spawned[1].p4port)
+        for depot in self.spawned:
+            self.assertTrue(os.path.isfile(os.path.join(depot.p4root, "db.have")))
+
+
+    def test_acquire_release(self):
+        self.pool.start()
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertNotEqual(first, second)
+        self.assertRaises(RuntimeError, self.pool.acquire, 0.01)
+        self.pool.release(first)
+        self.assertEqual(first, self.pool.acquire(0.01))
+
+
+    def test_server_context_manager(self):
+        self.pool.start()
+        with self.pool.server() as depot:
+            self.pool.acquire(0.01)
+            self.assertRaises(RuntimeError, self.pool.acquire, 0.01)
+        self.assertEqual(depot, self.pool.acquire(0.01))
+
+
+    def test_release_reset(self):
+        self.pool.start()
+        depot = self.pool.acquire()
+        open(os.path.join(depot.p4root, "db.dirty"), "w").close()
+        self.pool.release(depot, reset=True)
+
+        self.assertEqual([depot], self.stopped)
+        fresh = self.spawned[-1]
+        self.assertNotEqual(depot, fresh)
+        self.assertEqual(depot.pool_index, fresh.pool_index)
+        self.assertFalse(os.path.exists(os.path.join(fresh.p4root, "db.dirty")))
+        self.assertTrue(fresh in self.pool.servers)
+        self.assertFalse(depot in self.pool.servers)
+
+
+    def test_shutdown(self):
+        self.pool.start()
+        depots = list(self.spawned)
+        self.pool.shutdown()
+        self.assertEqual(depots, self.stopped)
+        for depot in depots:
+            self.assertFalse(os.path.exists(depot.parent_dir))
+        self.assertEqual([], self.pool.servers)
+
+        # A second shutdown (e.g. from atexit) does nothing.
+        self.pool.shutdown()
+        self.assertEqual(depots, self.stopped)
+
+
+    def test_failed_start_tears_down(self):
+        def spawn(depot, timeout=30):
+            if self.spawned:
+                raise RuntimeError("p4d did not start")
+            self.spawned.append(depot)
+        SampleDepot.server_spawn = spawn
+        self.assertRaises(RuntimeError, self.pool.start)
+        # The running server, plus every attempt at the one that failed.
+        self.assertEqual(1 + SPAWN_ATTEMPTS, len(self.stopped))
+        self.assertEqual([], os.listdir(os.path.join(self.tmp, "work")))
+
+
+    def test_spawn_retried_on_new_port(self):
+        failed = []
+        def spawn(depot, timeout=30):
+            if not failed:
+                failed.append(depot)
+                raise RuntimeError("p4d did not start")
+            self.spawned.append(depot)
+        SampleDepot.server_spawn = spawn
+        self.pool.start()
+        self.assertEqual(2, len(self.spawned))
+        self.assertEqual(failed, self.stopped)
+        self.assertNotEqual(failed[0].p4port, self.spawned[0].p4port)
+
+
+    def test_failed_reset_shrinks_pool(self):
+        self.pool.start()
+        depot = self.pool.acquire()
+        SampleDepot.server_spawn = failing_spawn
+        self.assertRaises(RuntimeError, self.pool.release, depot, True)
+        self.assertEqual(1, self.pool.size)
+        self.assertEqual(None, self.pool.servers[depot.pool_index])
+
+        # The other server is still there.
+        other = self.pool.acquire(0.01)
+        self.assertNotEqual(depot, other)
+        self.assertRaises(RuntimeError, self.pool.release, other, True)
+        self.assertEqual(0, self.pool.size)
+
+
+    def test_empty_pool_does_not_block(self):
+        self.pool.start()
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        SampleDepot.server_spawn = failing_spawn
+        self.assertRaises(RuntimeError, self.pool.release, first, True)
+        self.assertRaises(RuntimeError, self.pool.release, second, True)
+
+        # No timeout, but no servers will ever come back either.
+        self.assertRaises(RuntimeError, self.pool.acquire)
+        self.assertRaises(RuntimeError, self.pool.acquire)
+
+
+    def test_shutdown_registered_once(self):
+        registered = []
+        saved = p4_sample_depot.atexit.register
+        p4_sample_depot.atexit.register = registered.append
+        try:
+            pool = ServerPool(self.snapshot, os.path.join(self.tmp, "work2"), 1)
+            pool.start()
+            pool.shutdown()
+            pool.start()
+            pool.shutdown()
+        finally:
+            p4_sample_depot.atexit.register = saved
+        self.assertEqual([pool.shutdown], registered)
+
+
+class TestCloneTree(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "PerforceSample")
+        self.dest = os.path.join(self.tmp, "clone")
+        os.makedirs(os.path.join(self.src, "depot", "Jam"))
+        os.makedirs(os.path.join(self.src, "server.locks", "clients"))
+        self.lock = os.path.join("server.locks", "clients", "10,d")
+        for name in ["db.have", "journal", os.path.join("depot", "Jam", "Jambase,v"), SNAPSHOT_READY, self.lock]:
+            f = open(os.path.join(self.src, name), "w")
+            f.write(name)
+            f.close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+    def test_db_files_copied(self):
+        clone_tree(self.src, self.dest)
+        for name in ["db.have", "journal"]:
+            self.assertFalse(os.path.samefile(os.path.join(self.src, name), os.path.join(self.dest, name)))
+
+
+    def test_archive_files_linked(self):
+        clone_tree(self.src, self.dest)
+        archive = os.path.join("depot", "Jam", "Jambase,v")
+        self.assertTrue(os.path.samefile(os.path.join(self.src, archive), os.path.join(self.dest, archive)))
+
+
+    def test_lock_files_copied(self):
+        clone_tree(self.src, self.dest)
+        self.assertFalse(os.path.samefile(os.path.join(self.src, self.lock), os.path.join(self.dest, self.lock)))
+
+
+    def test_snapshot_marker_not_cloned(self):
+        clone_tree(self.src, self.dest)
+        self.assertFalse(os.path.exists(os.path.join(self.dest, SNAPSHOT_READY)))
+
+
+class TestSnapshotCache(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = SnapshotCache("sample.tar.gz", self.tmp)
+        self.stopped = []
+        self.cache.depot.server_stop = lambda: self.stopped.append(True)
+
+        # Leave a partial snapshot behind, as if an earlier build failed.
+        os.makedirs(self.cache.p4root)
+        open(os.path.join(self.cache.p4root, "db.partial"), "w").close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+    def fake_install(self):
+        os.makedirs(self.cache.p4root)
+        open(os.path.join(self.cache.p4root, "db.have"), "w").close()
+
+
+    def failed_install(self):
+        raise subprocess.CalledProcessError(1, "p4d -jr checkpoint")
+
+
+    def test_failed_build_not_ready(self):
+        self.cache.depot.server_install = self.failed_install
+        self.assertRaises(subprocess.CalledProcessError, self.cache.prepare)
+        self.assertFalse(self.cache.is_ready())
+
+
+    def test_build_replaces_partial_snapshot(self):
+        self.cache.depot.server_install = self.fake_install
+        self.assertEqual(self.cache.p4root, self.cache.prepare())
+        self.assertTrue(self.cache.is_ready())
+        self.assertFalse(os.path.exists(os.path.join(self.cache.p4root, "db.partial")))
+
+
+    def test_build_does_not_stop_servers(self):
+        self.cache.depot.server_install = self.fake_install
+        self.cache.prepare()
+        self.assertEqual([], self.stopped)
+        self.assertNotEqual(1492, self.cache.depot.p4port)
+
+
+    def test_snapshot_ready(self):
+        self.assertFalse(self.cache.is_ready())
+        open(os.path.join(self.cache.p4root, SNAPSHOT_READY), "w").close()
+        self.assertTrue(self.cache.is_ready())
+
+
+    def test_ready_snapshot_not_rebuilt(self):
+        self.cache.depot.server_install = self.fake_install
+        self.cache.prepare()
+        self.cache.depot.server_install = self.failed_install
+        self.assertEqual(self.cache.p4root, self.cache.prepare())
+
+
+class TestFreePort(TestCase):
+
+    def test_port_is_bindable(self):
+        port = free_port()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(("localhost", port))
+        finally:
+            s.close()
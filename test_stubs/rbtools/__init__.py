@@ -0,0 +1,6 @@
+# Just enough of rbtools for the post script to import in tests.
+VERSION = (0, 5, 2, 'final', 0, True)
+
+
+def get_package_version():
+    return "0.5.2"
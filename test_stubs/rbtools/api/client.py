@@ -0,0 +1,6 @@
+class RBClient(object):
+    def __init__(self, url, *args, **kwargs):
+        self.url = url
+
+    def get_root(self, *args, **kwargs):
+        raise NotImplementedError("Tests must not talk to a Review Board server.")
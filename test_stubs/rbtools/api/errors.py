@@ -0,0 +1,6 @@
+class APIError(Exception):
+    def __init__(self, http_status=None, error_code=None, rsp=None):
+        Exception.__init__(self, http_status, error_code)
+        self.http_status = http_status
+        self.error_code = error_code
+        self.rsp = rsp
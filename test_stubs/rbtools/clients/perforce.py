@@ -0,0 +1,9 @@
+class PerforceClient(object):
+    def __init__(self, options=None, **kwargs):
+        self.options = options
+
+    def get_repository_info(self):
+        return None
+
+    def diff(self, revisions, *args, **kwargs):
+        return "", None